@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import os
+import threading
+import types
+import streamlit as st
+import httpx # Non-blocking HTTP client shared by both apps
+import orjson # C-accelerated JSON encoding and decoding
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# API Key - Read from GEMINI_API_KEY; left empty, the Canvas environment provides it at runtime.
+API_KEY = os.environ.get("GEMINI_API_KEY", "")
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+
+# Built once at import; only the model name is filled in per call
+GENERATE_URL_TEMPLATE = f"{BASE_URL}/{{model}}:generateContent"
+# alt=sse streams the response as server-sent events
+STREAM_URL_TEMPLATE = f"{BASE_URL}/{{model}}:streamGenerateContent?alt=sse"
+
+# The key goes in a header rather than the URL, which httpx includes in error messages
+HEADERS = types.MappingProxyType({'Content-Type': 'application/json', 'x-goog-api-key': API_KEY})
+
+# Joins a static prefix to its per-request suffix; kept constant so the
+# prefix bytes are identical across requests and Gemini's implicit prompt
+# cache can reuse them
+PREFIX_SEPARATOR = "\n\n"
+
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Token bucket shared by every request in the process, so concurrent day
+# requests and emails from other sessions don't burst past the quota
+_rate_limiter = AsyncLimiter(60, 60)
+
+
+def _is_retryable(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+# Exponential backoff with jitter, giving up after 5 attempts
+_retry = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_random_exponential(multiplier=0.5, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+
+def freeze(value):
+    """
+    Returns a read-only copy of a JSON-like structure, for module-level constants.
+
+    Dicts become MappingProxyType and lists become tuples; both still
+    serialize as JSON objects and arrays when sent to the API.
+    """
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class GeminiResponseError(Exception):
+    """Raised when the Gemini API answers with an unexpected response format."""
+
+    def __init__(self, result):
+        super().__init__("Unexpected response format from Gemini API.")
+        self.result = result
+
+
+def new_client():
+    """Creates an AsyncClient suited to Gemini calls (HTTP/2, generous timeout)."""
+    return httpx.AsyncClient(http2=True, timeout=60)
+
+
+# One event loop per process, running on a background thread, with the
+# client whose connection pool and TLS sessions live on it. Created together
+# so a cleared cache never pairs a client with a different loop.
+@st.cache_resource(show_spinner=False)
+def _background_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop, new_client()
+
+
+def get_loop():
+    """Returns the shared background event loop."""
+    return _background_loop()[0]
+
+
+def get_client():
+    """Returns the shared AsyncClient; only use it from coroutines on get_loop()."""
+    return _background_loop()[1]
+
+
+def run(coro):
+    """Runs a coroutine on the shared loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iterate(async_gen):
+    """Drives an async generator on the shared loop from synchronous code."""
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_gen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        asyncio.run_coroutine_threadsafe(async_gen.aclose(), loop).result()
+
+
+@contextlib.asynccontextmanager
+async def _client_or_new(client):
+    # Use the caller's client, or open one just for this call
+    if client is not None:
+        yield client
+    else:
+        async with new_client() as client:
+            yield client
+
+
+def _encode_payload(prompt, schema, prefix):
+    if prefix is not None:
+        prompt = prefix + PREFIX_SEPARATOR + prompt
+
+    payload = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [{"text": prompt}]
+            }
+        ]
+    }
+    if schema is not None:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": schema
+        }
+    # default=dict serializes frozen (MappingProxyType) schemas
+    return orjson.dumps(payload, default=dict)
+
+
+def _response_text(result):
+    # Text of the first candidate; chunks without parts (e.g. the final one of a stream) yield ""
+    if not result or not result.get('candidates'):
+        raise GeminiResponseError(result)
+    parts = result['candidates'][0].get('content', {}).get('parts', [])
+    return "".join(part.get('text', '') for part in parts)
+
+
+@_retry
+async def _post(client, api_url, content):
+    async with _rate_limiter:
+        response = await client.post(api_url, headers=HEADERS, content=content)
+    response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
+    return response
+
+
+@_retry
+async def _open_stream(client, api_url, content):
+    # Only opening the stream is retried; a retry mid-stream would repeat text
+    async with _rate_limiter:
+        request = client.build_request("POST", api_url, headers=HEADERS, content=content)
+        response = await client.send(request, stream=True)
+    if response.is_error:
+        await response.aread() # Load the body so the error can be reported
+        await response.aclose()
+        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
+    return response
+
+
+async def generate(prompt, schema=None, model=DEFAULT_MODEL, client=None, prefix=None):
+    """
+    Calls the Gemini generateContent endpoint.
+
+    Args:
+        prompt (str): Prompt text, or only its dynamic part when `prefix` is given.
+        schema (dict or None): Response schema; when given the reply is JSON.
+        model (str): Gemini model name.
+        client (httpx.AsyncClient or None): Client to reuse; a new one is opened if None.
+        prefix (str or None): Static instructions shared across calls; sent first, unchanged.
+
+    Returns:
+        dict or str: Parsed JSON when a schema is given, the plain text otherwise.
+
+    Raises:
+        httpx.HTTPError: If the API call fails after retrying transient errors.
+        GeminiResponseError: If the response does not contain generated text.
+        orjson.JSONDecodeError: If the generated text is not valid JSON.
+    """
+    api_url = GENERATE_URL_TEMPLATE.format(model=model)
+    async with _client_or_new(client) as client:
+        content = _encode_payload(prompt, schema, prefix)
+        response = await _post(client, api_url, content)
+
+    result = orjson.loads(response.content)
+    text = _response_text(result)
+    if not text:
+        raise GeminiResponseError(result)
+    return orjson.loads(text) if schema is not None else text
+
+
+async def stream(prompt, schema=None, model=DEFAULT_MODEL, client=None, prefix=None):
+    """
+    Calls the Gemini streamGenerateContent endpoint.
+
+    Args:
+        prompt (str): Prompt text, or only its dynamic part when `prefix` is given.
+        schema (dict or None): Response schema; when given the reply is JSON.
+        model (str): Gemini model name.
+        client (httpx.AsyncClient or None): Client to reuse; a new one is opened if None.
+        prefix (str or None): Static instructions shared across calls; sent first, unchanged.
+
+    Yields:
+        str: Fragments of generated text, in order.
+
+    Raises:
+        httpx.HTTPError: If the API call fails after retrying transient errors.
+        GeminiResponseError: If a streamed event has no candidates.
+    """
+    api_url = STREAM_URL_TEMPLATE.format(model=model)
+    async with _client_or_new(client) as client:
+        content = _encode_payload(prompt, schema, prefix)
+        response = await _open_stream(client, api_url, content)
+        try:
+            async for line in response.aiter_lines():
+                if line.startswith('data:'):
+                    yield _response_text(orjson.loads(line[len('data:'):]))
+        finally:
+            await response.aclose()
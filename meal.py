@@ -1,126 +1,317 @@
 import streamlit as st
+import asyncio
+import hashlib
 import json
-import requests # Used for making HTTP requests to the Gemini API
+import re
+import diskcache # Durable cache so repeated inputs skip the Gemini call across restarts
+import httpx
+import ijson # Incremental JSON parsing of streamed responses
+import gemini_client
+from gemini_client import GeminiResponseError
 
-# API Key - Leave as empty string. The Canvas environment will provide it at runtime.
-API_KEY = ""
+# On-disk cache for generated plans; entries expire after a week
+MEAL_CACHE_DIR = "/tmp/meal_cache"
+MEAL_CACHE_EXPIRE = 7 * 86400
 
-# Function to call the Gemini API
-async def generate_meal_plan(preferences, goals, num_meals_per_day):
+
+# Cache handles are opened once per process rather than on every rerun
+@st.cache_resource(show_spinner=False)
+def get_meal_cache():
+    return diskcache.Cache(MEAL_CACHE_DIR)
+
+
+# Days of the week; each one is requested from Gemini concurrently
+DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Upper bound on in-flight Gemini requests, to stay within rate limits
+MAX_CONCURRENT_REQUESTS = 4
+
+# JSON schema for one day of the plan; read-only and built once. Keys are
+# single letters because the model repeats them for every meal, and the meal
+# type is an enum so it costs a single token.
+RESPONSE_SCHEMA = gemini_client.freeze({
+    "type": "OBJECT",
+    "properties": {
+        "m": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "t": { "type": "STRING", "format": "enum", "enum": ["breakfast", "lunch", "dinner", "snack"] },
+                    "n": { "type": "STRING" },
+                    "i": {
+                        "type": "ARRAY",
+                        "items": { "type": "STRING" }
+                    },
+                    "x": { "type": "STRING" }
+                },
+                "required": ["t", "n", "i", "x"]
+            }
+        }
+    },
+    "required": ["m"]
+})
+
+
+def _expand_meal(meal):
+    # Maps a compact meal from the response schema back to the display fields
+    return {
+        "type": meal['t'].title(),
+        "recipe_name": meal['n'],
+        "ingredients": meal['i'],
+        "instructions": meal['x'],
+    }
+
+# Leading quantity and unit on an ingredient line, e.g. "2 cups " or "1/2 tsp "
+QUANTITY_PATTERN = re.compile(r'^\d+[\d/.\s]*(cup|tbsp|tsp|g|oz|lb|ml)s?\s+', flags=re.I)
+
+
+def normalize_ingredient(ingredient):
+    """Lowercases an ingredient and strips a leading quantity so duplicates collapse."""
+    return QUANTITY_PATTERN.sub('', ingredient.strip()).lower()
+
+
+def build_shopping_list(weekly_meal_plan):
+    """
+    Builds the shopping list locally from the ingredients of every meal.
+
+    Args:
+        weekly_meal_plan (list): Day plans, each with a list of meals.
+
+    Returns:
+        list: Sorted, de-duplicated ingredient names.
+    """
+    return sorted({
+        normalize_ingredient(ingredient)
+        for day_plan in weekly_meal_plan
+        for meal in day_plan['meals']
+        for ingredient in meal['ingredients']
+    })
+
+
+# Seconds to coalesce streamed meals before handing them to Streamlit
+STREAM_BATCH_WINDOW = 0.15
+
+# Static instructions shared by every day request; kept byte-identical so
+# Gemini can reuse them from its prompt cache
+MEAL_PLAN_PREFIX = """Create a detailed meal plan for one day of a 7-day weekly meal plan, including breakfast, lunch, and dinner when there are 3 meals per day. Adjust meals based on the specified number of meals per day.
+For each meal, include a recipe name, a list of ingredients, and cooking instructions.
+The output MUST be in JSON format, adhering strictly to the following structure.
+Use these keys: m = list of meals; for each meal, t = meal type, n = recipe name, i = ingredients, x = cooking instructions.
+Provide realistic, diverse, and well-balanced meals."""
+
+
+# Function to call the Gemini API for a single day. Errors are raised rather
+# than reported so that failed calls are never cached.
+async def _stream_day_meals(client, semaphore, day, preferences, goals, num_meals_per_day):
     """
-    Calls the Gemini API to generate a meal plan and shopping list.
+    Streams the meals for one day from the Gemini API.
 
     Args:
+        client (httpx.AsyncClient): Client shared by all requests of a plan.
+        semaphore (asyncio.Semaphore): Limits concurrent requests.
+        day (str): Day of the week to plan.
         preferences (str): Dietary preferences (e.g., vegan, keto, gluten-free).
         goals (str): Health goals (e.g., weight loss, muscle gain, maintenance).
         num_meals_per_day (int): Number of meals to generate per day.
 
-    Returns:
-        dict or None: Parsed JSON meal plan and shopping list, or None if an error occurs.
+    Yields:
+        dict: Each meal as soon as its JSON object is complete.
+
+    Raises:
+        httpx.HTTPError: If the API call fails.
+        GeminiResponseError: If the response does not contain generated text.
+        ijson.JSONError: If the generated text is not valid JSON.
     """
-    prompt = f"""
-    Create a detailed 7-day weekly meal plan, including breakfast, lunch, and dinner (if {num_meals_per_day} is 3). Adjust meals based on the specified number of meals per day.
-    For each meal, include a recipe name, a list of ingredients, and cooking instructions.
-    Finally, provide a consolidated shopping list for the entire week's meal plan.
-
-    Dietary Preferences: {preferences}
-    Goals: {goals}
-    Number of meals per day: {num_meals_per_day}
-
-    The output MUST be in JSON format, adhering strictly to the following structure.
-    Ensure all ingredients mentioned in recipes are included in the shopping_list.
-    Provide realistic, diverse, and well-balanced meals.
+    prompt = f"""Day: {day}
+Dietary Preferences: {preferences}
+Goals: {goals}
+Number of meals per day: {num_meals_per_day}"""
+
+    # Meals are parsed incrementally as the JSON text arrives
+    meals = ijson.sendable_list()
+    parser = ijson.items_coro(meals, 'm.item')
+
+    async with semaphore:
+        async for text in gemini_client.stream(prompt, RESPONSE_SCHEMA, client=client, prefix=MEAL_PLAN_PREFIX):
+            parser.send(text.encode())
+            for meal in meals:
+                yield _expand_meal(meal)
+            del meals[:]
+    parser.close()
+    for meal in meals:
+        yield _expand_meal(meal)
+
+
+async def stream_meal_plan(client, preferences, goals, num_meals_per_day):
     """
+    Streams all days of the week concurrently.
 
-    # Define the JSON schema for the desired output
-    response_schema = {
-        "type": "OBJECT",
-        "properties": {
-            "weekly_meal_plan": {
-                "type": "ARRAY",
-                "items": {
-                    "type": "OBJECT",
-                    "properties": {
-                        "day": { "type": "STRING" },
-                        "meals": {
-                            "type": "ARRAY",
-                            "items": {
-                                "type": "OBJECT",
-                                "properties": {
-                                    "type": { "type": "STRING" },
-                                    "recipe_name": { "type": "STRING" },
-                                    "ingredients": {
-                                        "type": "ARRAY",
-                                        "items": { "type": "STRING" }
-                                    },
-                                    "instructions": { "type": "STRING" }
-                                },
-                                "required": ["type", "recipe_name", "ingredients", "instructions"]
-                            }
-                        }
-                    },
-                    "required": ["day", "meals"]
-                }
-            },
-            "shopping_list": {
-                "type": "ARRAY",
-                "items": { "type": "STRING" }
-            }
-        },
-        "required": ["weekly_meal_plan", "shopping_list"]
-    }
+    Args:
+        client (httpx.AsyncClient): Client shared by all requests of a plan.
+        preferences (str): Dietary preferences (e.g., vegan, keto, gluten-free).
+        goals (str): Health goals (e.g., weight loss, muscle gain, maintenance).
+        num_meals_per_day (int): Number of meals to generate per day.
 
-    headers = {
-        'Content-Type': 'application/json'
-    }
+    Yields:
+        list: Batches of (day_index, meal) pairs, coalesced over
+        STREAM_BATCH_WINDOW so the UI isn't updated once per chunk.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    queue = asyncio.Queue()
+
+    async def pump(day_index, day):
+        try:
+            async for meal in _stream_day_meals(client, semaphore, day, preferences, goals, num_meals_per_day):
+                await queue.put((day_index, meal))
+        except Exception as e:
+            await queue.put((day_index, e)) # Fails the plan without waiting for the other days
+        finally:
+            await queue.put((day_index, None)) # Marks this day as finished
+
+    tasks = [asyncio.create_task(pump(day_index, day)) for day_index, day in enumerate(DAYS)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            items = [item]
+            if not isinstance(item[1], Exception):
+                await asyncio.sleep(STREAM_BATCH_WINDOW) # Let more meals accumulate
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            for _, meal in items:
+                if isinstance(meal, Exception):
+                    raise meal
+            batch = [(day_index, meal) for day_index, meal in items if meal is not None]
+            remaining -= len(items) - len(batch)
+            if batch:
+                yield batch
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _norm(text):
+    # Case and whitespace differences ("Vegan " vs "vegan") shouldn't miss the cache
+    return re.sub(r'\s+', ' ', text.strip().lower())
+
+
+def _meal_plan_key(preferences, goals, num_meals_per_day):
+    # Content hash of the normalized inputs, used by both cache layers
+    normalized = f"{_norm(preferences)}|{_norm(goals)}|{num_meals_per_day}"
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+# Only exact (normalized) matches are reused: preferences often carry
+# allergies and restrictions, which embedding similarity can't tell apart
+@st.cache_data(ttl=86400, show_spinner=False)
+def _cached_meal_plan(key):
+    # Raises KeyError on a miss, which st.cache_data does not cache
+    meal_plan = get_meal_cache().get(key)
+    if meal_plan is None:
+        raise KeyError(key)
+    return meal_plan
 
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": prompt}]
-            }
-        ],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": response_schema
-        }
-    }
 
-    # Construct the API URL
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={API_KEY}"
+def _store_meal_plan(key, meal_plan):
+    get_meal_cache().set(key, meal_plan, expire=MEAL_CACHE_EXPIRE)
+
+
+def generate_meal_plan(preferences, goals, num_meals_per_day, on_meals):
+    """
+    Returns a meal plan for the given inputs, served from cache when the same
+    input was seen before and streamed from the Gemini API otherwise.
+
+    Args:
+        preferences (str): Dietary preferences (e.g., vegan, keto, gluten-free).
+        goals (str): Health goals (e.g., weight loss, muscle gain, maintenance).
+        num_meals_per_day (int): Number of meals to generate per day.
+        on_meals (callable): Called with each batch of (day_index, meal) pairs
+            as they become available.
+
+    Returns:
+        dict or None: Parsed JSON meal plan and shopping list, or None if an error occurs.
+    """
+    key = _meal_plan_key(preferences, goals, num_meals_per_day)
+    try:
+        meal_plan = _cached_meal_plan(key)
+    except KeyError:
+        meal_plan = None
+    if meal_plan is not None:
+        on_meals([
+            (day_index, meal)
+            for day_index, day_data in enumerate(meal_plan['weekly_meal_plan'])
+            for meal in day_data['meals']
+        ])
+        return meal_plan
 
     try:
-        # Make the API call
-        response = requests.post(api_url, headers=headers, json=payload)
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx or 5xx)
-
-        result = response.json()
-
-        # Check if the response contains the expected structure
-        if result and result.get('candidates') and result['candidates'][0].get('content') and \
-           result['candidates'][0]['content'].get('parts') and result['candidates'][0]['content']['parts'][0].get('text'):
-            
-            json_string = result['candidates'][0]['content']['parts'][0]['text']
-            # Parse the text content as JSON
-            parsed_json = json.loads(json_string)
-            return parsed_json
-        else:
-            st.error("Error: Unexpected response format from Gemini API.")
-            st.json(result) # Display the raw response for debugging
-            return None
-    except requests.exceptions.RequestException as e:
+        weekly_meals = [[] for _ in DAYS]
+        # Runs on the shared background loop, reusing its pooled connections
+        meal_stream = stream_meal_plan(gemini_client.get_client(), preferences, goals, num_meals_per_day)
+        for batch in gemini_client.iterate(meal_stream):
+            for day_index, meal in batch:
+                weekly_meals[day_index].append(meal)
+            on_meals(batch)
+    except httpx.HTTPError as e:
         st.error(f"Error connecting to Gemini API: {e}")
         return None
-    except json.JSONDecodeError as e:
+    except GeminiResponseError as e:
+        st.error(f"Error: {e}")
+        st.json(e.result) # Display the raw response for debugging
+        return None
+    except (json.JSONDecodeError, ijson.JSONError) as e:
         st.error(f"Error parsing JSON response from Gemini API: {e}")
-        st.write("Raw API response content (might be malformed JSON):")
-        st.code(response.text) # Show the problematic raw text
         return None
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
         return None
 
+    weekly_meal_plan = [{"day": day, "meals": meals} for day, meals in zip(DAYS, weekly_meals)]
+    meal_plan = {"weekly_meal_plan": weekly_meal_plan, "shopping_list": build_shopping_list(weekly_meal_plan)}
+    _store_meal_plan(key, meal_plan)
+    return meal_plan
+
+
+def render_meal(meal):
+    st.markdown(f"**{meal['type']}:** {meal['recipe_name']}")
+    st.markdown("**Ingredients:**")
+    for ingredient in meal['ingredients']:
+        st.write(f"- {ingredient}")
+    st.markdown("**Instructions:**")
+    st.markdown(meal['instructions'])
+    st.markdown("---")
+
+
+# Fragments rerun on their own, so ticking a shopping-list item doesn't
+# re-render the seven day tabs
+@st.fragment
+def show_weekly_plan(meal_plan_data):
+    st.header("Weekly Meal Plan 🗓️")
+    tabs = st.tabs([day_data['day'] for day_data in meal_plan_data['weekly_meal_plan']])
+    for tab, day_data in zip(tabs, meal_plan_data['weekly_meal_plan']):
+        with tab:
+            st.subheader(f"___{day_data['day']}___")
+            if day_data['meals']:
+                for meal in day_data['meals']:
+                    render_meal(meal)
+            else:
+                st.write("No meals planned for this day.")
+
+
+@st.fragment
+def show_shopping_list(meal_plan_data):
+    st.header("Shopping List 🛒")
+    shopping_list = meal_plan_data.get('shopping_list', [])
+    if shopping_list:
+        cols = st.columns(3) # Display in 3 columns for better readability
+        for idx, item in enumerate(shopping_list):
+            st.session_state.setdefault(f"item_{idx}", False)
+            cols[idx % 3].checkbox(item, key=f"item_{idx}")
+    else:
+        st.write("No shopping list generated.")
+
 # --- Streamlit UI ---
 st.set_page_config(page_title="🍽️ AI Meal Plan Generator", layout="wide")
 
@@ -154,42 +345,47 @@ if generate_button:
     if not dietary_preferences:
         st.warning("Please enter your dietary preferences.")
     else:
-        st.info("Generating your personalized meal plan... This might take a moment!")
-        
+        status = st.empty()
+        status.info("Generating your personalized meal plan... This might take a moment!")
+
+        # Display Weekly Meal Plan; meals are filled in as they stream in.
+        # Held in a placeholder so a partial plan can be cleared on failure.
+        plan_area = st.empty()
+        with plan_area.container():
+            st.header("Weekly Meal Plan 🗓️")
+            tabs = st.tabs(list(DAYS))
+            day_containers = []
+            for tab, day in zip(tabs, DAYS):
+                with tab:
+                    st.subheader(f"___{day}___")
+                    day_containers.append(st.container())
+
+        def show_meals(batch):
+            for day_index, meal in batch:
+                with day_containers[day_index]:
+                    render_meal(meal)
+
         # Use st.spinner for a loading indicator
         with st.spinner('Crafting your delicious weekly plan...'):
-            import asyncio
-            meal_plan_data = asyncio.run(generate_meal_plan(dietary_preferences, health_goals, num_meals))
+            meal_plan_data = generate_meal_plan(dietary_preferences, health_goals, num_meals, show_meals)
 
         if meal_plan_data:
-            st.success("Meal Plan Generated Successfully!")
+            status.success("Meal Plan Generated Successfully!")
 
-            # Display Weekly Meal Plan
-            st.header("Weekly Meal Plan 🗓️")
-            tab_titles = [day_data['day'] for day_data in meal_plan_data['weekly_meal_plan']]
-            tabs = st.tabs(tab_titles)
-
-            for i, day_data in enumerate(meal_plan_data['weekly_meal_plan']):
-                with tabs[i]:
-                    st.subheader(f"___{day_data['day']}___")
-                    if day_data['meals']:
-                        for meal in day_data['meals']:
-                            st.markdown(f"**{meal['type']}:** {meal['recipe_name']}")
-                            st.markdown("**Ingredients:**")
-                            for ingredient in meal['ingredients']:
-                                st.write(f"- {ingredient}")
-                            st.markdown("**Instructions:**")
-                            st.markdown(meal['instructions'])
-                            st.markdown("---")
-                    else:
-                        st.write("No meals planned for this day.")
-
-            # Display Shopping List
-            st.header("Shopping List 🛒")
-            shopping_list = meal_plan_data.get('shopping_list', [])
-            if shopping_list:
-                cols = st.columns(3) # Display in 3 columns for better readability
-                for idx, item in enumerate(shopping_list):
-                    cols[idx % 3].checkbox(item, value=False, key=f"item_{idx}")
-            else:
-                st.write("No shopping list generated.")
+            for day_container, day_data in zip(day_containers, meal_plan_data['weekly_meal_plan']):
+                if not day_data['meals']:
+                    day_container.write("No meals planned for this day.")
+
+            # Keep the plan across reruns and start with a clean shopping list
+            st.session_state["plan"] = meal_plan_data
+            for key in [key for key in st.session_state if key.startswith("item_")]:
+                del st.session_state[key]
+
+            show_shopping_list(meal_plan_data)
+        else:
+            # The error is already shown; drop the progress message and the half-filled tabs
+            status.empty()
+            plan_area.empty()
+elif "plan" in st.session_state:
+    show_weekly_plan(st.session_state["plan"])
+    show_shopping_list(st.session_state["plan"])
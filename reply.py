@@ -1,40 +1,68 @@
 import streamlit as st
 import os
-from fpdf import FPDF
-from google.generativeai import GenerativeModel, configure
+import hashlib
+import diskcache # Durable cache so repeated requests skip the Gemini call across restarts
+import httpx
+import gemini_client
+from gemini_client import GeminiResponseError
 
-# Configure Gemini API key (ensure it's set in your environment or directly here)
-GEMINI_API_KEY = "YOUR_GEMINI_API_KEY"
-configure(api_key=GEMINI_API_KEY)
-model = GenerativeModel("gemini-pro")
+# On-disk cache for generated emails. Applicant messages and emails are
+# personal data, so they expire after a week.
+EMAIL_CACHE_DIR = "/tmp/email_cache"
+EMAIL_CACHE_EXPIRE = 7 * 86400
 
-# Helper to generate email
-@st.cache_data(show_spinner=False)
+# Opened once per process rather than on every rerun. Only exact matches are
+# reused: "I can attend" and "I can't attend" need different replies.
+@st.cache_resource(show_spinner=False)
+def get_email_cache():
+    return diskcache.Cache(EMAIL_CACHE_DIR)
+
+# Static instructions shared by every email request; kept byte-identical so
+# Gemini can reuse them from its prompt cache
+EMAIL_PREFIX = """You are an HR manager. Write an email response to a job applicant.
+Please generate a professional email response."""
+
+# Helper to generate email. Kept in memory for a week; persist="disk" would
+# ignore the TTL, so emails survive restarts in the expiring store instead.
+@st.cache_data(show_spinner=False, ttl=EMAIL_CACHE_EXPIRE)
 def generate_email(applicant_text, tone, format_type, name, role, company):
-    prompt = f"""
-    You are an HR manager. Write an email response to a job applicant.
-    Applicant Name: {name}
-    Role Applied For: {role}
-    Company: {company}
-    Email Format: {format_type}
-    Tone: {tone}
-    Applicant Message: {applicant_text}
-    Please generate a professional email response.
-    """
-    response = model.generate_content(prompt)
-    return response.text.strip()
-
-# Helper to download email as PDF
+    prompt = f"""Applicant Name: {name}
+Role Applied For: {role}
+Company: {company}
+Email Format: {format_type}
+Tone: {tone}
+Applicant Message: {applicant_text}"""
+    # The prompt holds every input, so its hash identifies the request
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    email_content = get_email_cache().get(key)
+    if email_content is None:
+        # Runs on the shared background loop, reusing its pooled connections
+        email_content = gemini_client.run(
+            gemini_client.generate(prompt, client=gemini_client.get_client(), prefix=EMAIL_PREFIX)
+        ).strip()
+        get_email_cache().set(key, email_content, expire=EMAIL_CACHE_EXPIRE)
+    return email_content
+
+# Unicode TrueType font, so dashes, smart quotes and accented names render
+PDF_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Helper to download email as PDF. Rendered in memory and cached per content,
+# so widget interactions don't rebuild it.
+@st.cache_data(show_spinner=False)
 def create_pdf(content):
+    from fpdf import FPDF # Imported once an email is shown, not at page load
     pdf = FPDF()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Arial", size=12)
-    for line in content.split('\n'):
-        pdf.multi_cell(0, 10, line)
-    pdf_path = "/tmp/generated_email.pdf"
-    pdf.output(pdf_path)
-    return pdf_path
+    if os.path.exists(PDF_FONT_PATH):
+        pdf.add_font("DejaVu", "", PDF_FONT_PATH)
+        pdf.set_font("DejaVu", size=12)
+    else:
+        # Core fonts are latin-1 only; substitute anything they can't encode
+        pdf.set_font("Helvetica", size=12)
+        content = content.encode('latin-1', 'replace').decode('latin-1')
+    pdf.multi_cell(0, 10, content) # multi_cell handles the line breaks
+    return bytes(pdf.output())
 
 # Streamlit UI
 st.set_page_config(page_title="HR Email Generator", layout="centered")
@@ -62,9 +90,17 @@ if submitted:
     if applicant_text.strip() == "":
         st.error("Please paste the applicant's message.")
     else:
-        with st.spinner("Generating email..."):
-            email_content = generate_email(applicant_text, tone, format_type, name, role, company)
+        try:
+            with st.spinner("Generating email..."):
+                email_content = generate_email(applicant_text, tone, format_type, name, role, company)
             st.session_state.email_content = email_content
+        except httpx.HTTPError as e:
+            st.error(f"Error connecting to Gemini API: {e}")
+        except GeminiResponseError as e:
+            st.error(f"Error: {e}")
+            st.json(e.result) # Display the raw response for debugging
+        except Exception as e:
+            st.error(f"An unexpected error occurred: {e}")
 
 # Display generated email
 if st.session_state.email_content:
@@ -73,14 +109,12 @@ if st.session_state.email_content:
     st.text_area("Email Response", value=st.session_state.email_content, height=300)
 
     # PDF download
-    pdf_file_path = create_pdf(st.session_state.email_content)
-    with open(pdf_file_path, "rb") as f:
-        st.download_button(
-            label="📥 Download Email as PDF",
-            data=f,
-            file_name="HR_Email_Response.pdf",
-            mime="application/pdf"
-        )
+    st.download_button(
+        label="📥 Download Email as PDF",
+        data=create_pdf(st.session_state.email_content),
+        file_name="HR_Email_Response.pdf",
+        mime="application/pdf"
+    )
 
     # Regenerate option
     if st.button("🔁 Regenerate Email with New Format/Tone"):